@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from optparse import OptionParser
-import xml.etree.cElementTree as XTree
+from xml.sax.saxutils import escape
 import re
+import struct
+import json
+import csv
+import hashlib
 import zipfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from uuid import uuid4
-from shutil import copyfile
-from PIL import Image
+from shutil import copyfile, copyfileobj
+
+
+ASSETS = [
+    ("css/reset.css",
+     "/* http://meyerweb.com/eric/tools/css/reset/\nv2.0 | 20110126\nLicense: none (public domain)\n*/\nhtml, body, div, span, applet, object, iframe,h1, h2, h3, h4, h5, h6, p, blockquote, pre, a, abbr, acronym, address, big, cite, code, del, dfn, em, img, ins, kbd, q, s, samp, small, strike, strong, sub, sup, tt, var, b, u, i, center, dl, dt, dd, ol, ul, li, fieldset, form, label, legend, table, caption, tbody, tfoot, thead, tr, th, td, article, aside, canvas, details, embed,  figure, figcaption, footer, header, hgroup,  menu, nav, output, ruby, section, summary, time, mark, audio, video {\nmargin: 0;\npadding: 0;\nborder: 0;\nfont-size: 100%;\nfont: inherit;\nvertical-align: baseline;\n}\na { color: black; text-decoration: none; }\n/* HTML5 display-role reset for older browsers */\narticle, aside, details, figcaption, figure, footer, header, hgroup, menu, nav, section {\ndisplay: block;\n}\nbody { line-height: 1; }\nol, ul { list-style: none; }\nblockquote, q { quotes: none; }\nblockquote:before, blockquote:after, q:before, q:after {\ncontent: "";\ncontent: none;\n}\ntable {\nborder-collapse: collapse;\nborder-spacing: 0;\n}"),
+    ("css/styles.css",
+     "body { width: 100%; height: 100%; }\nimg.full { height: 100%; top: 0; left: 0; z-index: -1; }\n\n@media amzn-kf8\n{\n\tbody { width: auto; height: auto; }\n\timg.full { width: auto; height : auto; top : auto; left : auto;}\n}\n\nsvg {\n\tposition:absolute;\n\ttop:0;\n\tleft:0;\n\tmargin:0;\n\tpadding:0;\n\theight:100% !important;\n\tmax-width:100% !important;\n}"),
+    ("css/stylesheet.css",
+     '@import url("reset.css");\n@import url("styles.css");'),
+    ("js/kobo.js",
+     "var gPosition = 0;\nvar gProgress = 0;\nvar gCurrentPage = 0;\nvar gPageCount = 0;\nvar gClientHeight = null;\n\nconst kMaxFont = 0;\n\nfunction getPosition()\n{\n\treturn gPosition;\n}\n\nfunction getProgress()\n{\n\treturn gProgress;\n}\n\nfunction getPageCount()\n{\n\treturn gPageCount;\n}\n\nfunction getCurrentPage()\n{\n\treturn gCurrentPage;\n}\n\n/**\n * Setup the columns and calculate the total page count;\n */\n\nfunction setupBookColumns()\n{\n\tvar body = document.getElementsByTagName('body')[0].style;\n\tbody.marginLeft = 0;\n\tbody.marginRight = 0;\n\tbody.marginTop = 0;\n\tbody.marginBottom = 0;\n\t\n    var bc = document.getElementById('book-columns').style;\n    bc.width = (window.innerWidth * 2) + 'px !important';\n\tbc.height = (window.innerHeight-kMaxFont) + 'px !important';\n    bc.marginTop = '0px !important';\n    bc.webkitColumnWidth = window.innerWidth + 'px !important';\n    bc.webkitColumnGap = '0px';\n\tbc.overflow = 'visible';\n\n\tgCurrentPage = 1;\n\tgProgress = gPosition = 0;\n\t\n\tvar bi = document.getElementById('book-inner').style;\n\tbi.marginLeft = '0px';\n\tbi.marginRight = '0px';\n\tbi.padding = '0';\n\n\tgPageCount = document.body.scrollWidth / window.innerWidth;\n\n\t// Adjust the page count to 1 in case the initial bool-columns.clientHeight is less than the height of the screen. We only do this once.2\n\n\tif (gClientHeight < (window.innerHeight-kMaxFont)) {\n\t\tgPageCount = 1;\n\t}\n}\n\n/**\n * Columnize the document and move to the first page. The position and progress are reset/initialized\n * to 0. This should be the initial pagination request when the document is initially shown.\n */\n\nfunction paginate()\n{\t\n\t// Get the height of the page. We do this only once. In setupBookColumns we compare this\n\t// value to the height of the window and then decide wether to force the page count to one.\n\t\n\tif (gClientHeight == undefined) {\n\t\tgClientHeight = document.getElementById('book-columns').clientHeight;\n\t}\n\t\n\tsetupBookColumns();\n}\n\n/**\n * Paginate the document again and maintain the current progress. This needs to be used when\n * the content view changes size. For example because of orientation changes. The page count\n * and current page are recalculated based on the current progress.\n */\n\nfunction paginateAndMaintainProgress()\n{\n\tvar savedProgress = gProgress;\n\tsetupBookColumns();\n\tgoProgress(savedProgress);\n}\n\n/**\n * Update the progress based on the current page and page count. The progress is calculated\n * based on the top left position of the page. So the first page is 0% and the last page is\n * always below 1.0.\n */\n\nfunction updateProgress()\n{\n\tgProgress = (gCurrentPage - 1.0) / gPageCount;\n}\n\n/**\n * Move a page back if possible. The position, progress and page count are updated accordingly.\n */\n\nfunction goBack()\n{\n\tif (gCurrentPage > 1)\n\t{\n\t\tgCurrentPage--;\n\t\tgPosition -= window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Move a page forward if possible. The position, progress and page count are updated accordingly.\n */\n\nfunction goForward()\n{\n\tif (gCurrentPage < gPageCount)\n\t{\n\t\tgCurrentPage++;\n\t\tgPosition += window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Move directly to a page. Remember that there are no real page numbers in a reflowed\n * EPUB document. Use this only in the context of the current document.\n */\n\nfunction goPage(pageNumber)\n{\n\tif (pageNumber > 0 && pageNumber <= gPageCount)\n\t{\n\t\tgCurrentPage = pageNumber;\n\t\tgPosition = (gCurrentPage - 1) * window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Go the the page with respect to progress. Assume everything has been setup.\n */\n\nfunction goProgress(progress)\n{\n\tprogress += 0.0001;\n\t\n\tvar progressPerPage = 1.0 / gPageCount;\n\tvar newPage = 0;\n\t\n\tfor (var page = 0; page < gPageCount; page++) {\n\t\tvar low = page * progressPerPage;\n\t\tvar high = low + progressPerPage;\n\t\tif (progress >= low && progress < high) {\n\t\t\tnewPage = page;\n\t\t\tbreak;\n\t\t}\n\t}\n\t\t\n\tgCurrentPage = newPage + 1;\n\tgPosition = (gCurrentPage - 1) * window.innerWidth;\n\twindow.scrollTo(gPosition, 0);\n\tupdateProgress();\t\t\n}\n\n//Set font family\nfunction setFontFamily(newFont) {\n\tdocument.body.style.fontFamily = newFont + ' !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Sets font size to a relative size\nfunction setFontSize(toSize) {\n\tdocument.getElementById('book-inner').style.fontSize = toSize + 'em !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Sets line height relative to font size\nfunction setLineHeight(toHeight) {\n\tdocument.getElementById('book-inner').style.lineHeight = toHeight + 'em !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Enables night reading mode\nfunction enableNightReading() {\n\tdocument.body.style.backgroundColor = '#000000';\n\tvar theDiv = document.getElementById('book-inner');\n\ttheDiv.style.color = '#ffffff';\n\t\n\tvar anchorTags;\n\tanchorTags = theDiv.getElementsByTagName('a');\n\t\n\tfor (var i = 0; i < anchorTags.length; i++) {\n\t\tanchorTags[i].style.color = '#ffffff';\n\t}\n}"),
+]
 
 
 def atoi(text):
@@ -17,176 +36,849 @@ def atoi(text):
 def natural_keys(text):
     return [atoi(c) for c in re.split(r'(\d+)', text)]
 
-def generate_toc_html(title, page=[]):
-    root = XTree.Element("html",
-                         {"xmlns": "http://www.w3.org/1999/xhtml", "xmlns:epub": "http://www.idpf.org/2007/ops"})
-    head = XTree.SubElement(root, "head")
-    XTree.SubElement(head, "title").text = "TOC "+title
-    XTree.SubElement(head, "meta", {"charset": "utf-8"})
-    XTree.SubElement(head, "script", {"xmlns": "http://www.w3.org/1999/xhtml", "type": "text/javascript", "src":"js/kobo.js"})
-
-    body = XTree.SubElement(root, "body")
-    toc = XTree.SubElement(body, "section", {"epub:type": "toc"})
-    XTree.SubElement(toc, "h1").text = title
-    nav = XTree.SubElement(toc, "nav", {"id": "toc", "epub:type": "toc"})
-    ol = XTree.SubElement(nav, "ol")
+def probe_image_size(fp):
+    head = fp.read(32)
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        if head[12:16] == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", head[26:30])
+            return width & 0x3fff, height & 0x3fff
+        if head[12:16] == b"VP8L" and head[20] == 0x2f:
+            bits = struct.unpack("<I", head[21:25])[0]
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if head[12:16] == b"VP8X":
+            return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+        return None
+    if head[:2] != b"\xff\xd8":
+        return None
+    # walk the JPEG marker segments up to the first SOFn, seeking over everything else
+    fp.seek(2)
+    while True:
+        byte = fp.read(1)
+        while byte == b"\xff":
+            byte = fp.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            continue
+        segment = fp.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack(">H", segment)[0]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            sof = fp.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack(">HH", sof[1:5])
+            return width, height
+        fp.seek(length - 2, 1)
+
+
+# open ZipFiles per process, a handle inherited from the parent would share its file offset
+ARCHIVES = {}
+
+
+def open_archive(archive):
+    key = (archive, os.getpid())
+    if key not in ARCHIVES:
+        ARCHIVES[key] = zipfile.ZipFile(archive)
+    return ARCHIVES[key]
+
+
+def open_image(file, archive=None):
+    if archive:
+        return open_archive(archive).open(file)
+    return open(file, "rb")
+
+
+def image_size(file, archive=None):
+    with open_image(file, archive) as fp:
+        size = probe_image_size(fp)
+    if size is None:
+        from PIL import Image
+        with open_image(file, archive) as fp, Image.open(fp) as img:
+            size = img.size
+    return size
+
+
+MEDIA_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp", "gif": "image/gif"}
+
+
+def media_type(format):
+    return MEDIA_TYPES.get(format, "image/"+format)
+
+
+class Page:
+    __slots__ = ("file", "name", "path", "key", "media_type", "digest")
+
+    def __init__(self, folder, file, format="png", path=None, digest=None):
+        self.file = file
+        self.name = file[:-len(format)-1]
+        self.path = path or folder+"/"+file
+        self.key = natural_keys(path or file)
+        self.media_type = media_type(format)
+        self.digest = digest
+
+
+class PageIndex:
+    __slots__ = ("folder", "format", "pages", "archive")
+
+    def __init__(self, folder, format="png"):
+        self.folder = folder
+        self.format = format
+        self.archive = None
+        if os.path.isfile(folder) and zipfile.is_zipfile(folder):
+            self.archive = folder
+            self.pages = self.scan_archive(folder)
+            return
+        self.pages = self.scan(folder)
+        if not self.pages and os.path.isdir(folder+"/images"):
+            # the pages of an earlier directory build have already been moved to images/
+            self.pages = self.scan(folder+"/images")
+
+    def scan(self, folder):
+        suffix = "."+self.format
+        pages = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffix) and entry.name != "Cover"+suffix and entry.is_file():
+                    pages.append(Page(folder, entry.name, self.format))
+        pages.sort(key=lambda page: page.key)
+        return pages
+
+    def scan_archive(self, archive):
+        suffix = "."+self.format
+        members = []
+        for info in open_archive(archive).infolist():
+            parts = info.filename.split("/")
+            if info.is_dir() or not parts[-1].endswith(suffix) or parts[-1] == "Cover"+suffix:
+                continue
+            # skip __MACOSX/ resource forks and hidden files like ._000.png
+            if any(part.startswith(".") or part == "__MACOSX" for part in parts):
+                continue
+            members.append(info)
+        # pages of different chapter folders may share a file name, so the folders below the common one become part of the name
+        common = os.path.commonpath([os.path.dirname(info.filename) for info in members]) if members else ""
+        pages = []
+        for info in members:
+            file = info.filename[len(common)+1:] if common else info.filename
+            # members are not read for the index, the crc and size stand in for a content hash
+            pages.append(Page(archive, file.replace("/", "-"), self.format, info.filename, "%08x-%d" % (info.CRC, info.file_size)))
+        pages.sort(key=lambda page: page.key)
+        return pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    @property
+    def start(self):
+        return self.pages[0].name if self.pages else "000"
+
+    def manifest(self, encoding=None):
+        items = []
+        itemrefs = []
+        for (i, page) in enumerate(self.pages):
+            items.append(("id" + str(i), page.name+".xhtml", "application/xhtml+xml", "scripted"))
+            itemrefs.append(spine_itemref("id" + str(i), i))
+        i = len(self.pages)
+        image_type = media_type(encoding) if encoding else media_type(self.format)
+        items.append(("cover", "Cover."+(encoding or self.format), image_type, None))
+        items.append(("toc.ncx", "toc.ncx", "application/x-dtbncx+xml", None))
+        items.append(("toc", "toc.xhtml", "application/xhtml+xml", "nav"))
+        for page in self.pages:
+            if encoding:
+                items.append(("id" + str(i), "images/"+page.name+"."+encoding, image_type, None))
+            else:
+                items.append(("id" + str(i), "images/"+page.file, page.media_type, None))
+            i += 1
+        for (name, data) in ASSETS:
+            items.append(("id" + str(i), name, "text/css" if name.endswith(".css") else "application/javascript", None))
+            i += 1
+        return items, itemrefs
+
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+INDENT = [b"\n" + b"\t" * depth for depth in range(8)]
+
+
+TEXT_SPECIAL = re.compile(r'[&<>]')
+ATTRIBUTE_SPECIAL = re.compile(r'[&<>"\r\n\t]')
+
+
+def text(value):
+    if TEXT_SPECIAL.search(value):
+        value = escape(value)
+    return value.encode("utf-8")
+
+
+def attribute(value):
+    if ATTRIBUTE_SPECIAL.search(value):
+        value = escape(value, {'"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#09;"})
+    return value.encode("utf-8")
+
+
+# documents are lists of (depth, fragment), the depth is only used when pretty printing
+def render(lines, pretty=True):
+    if not pretty:
+        return XML_DECLARATION + b"".join([fragment for (depth, fragment) in lines])
+    return XML_DECLARATION + lines[0][1] + b"".join([INDENT[depth] + fragment for (depth, fragment) in lines[1:]])
+
+
+def toc_html(title, page=[], pretty=True):
+    lines = [(0, b'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'),
+             (1, b"<head>"),
+             (2, b"<title>TOC " + text(title) + b"</title>"),
+             (2, b'<meta charset="utf-8" />'),
+             (2, b'<script xmlns="http://www.w3.org/1999/xhtml" type="text/javascript" src="js/kobo.js" />'),
+             (1, b"</head>"),
+             (1, b"<body>"),
+             (2, b'<section epub:type="toc">'),
+             (3, b"<h1>" + text(title) + b"</h1>"),
+             (3, b'<nav id="toc" epub:type="toc">'),
+             (4, b"<ol>")]
     for (site, titles) in page:
-        li = XTree.SubElement(ol, "li")
-        XTree.SubElement(li, "a", {"href": site}).text = titles
-    landmark = XTree.SubElement(body, "nav", {"epub:type": "landmarks"})
-    ol = XTree.SubElement(landmark, "ol")
-    li = XTree.SubElement(ol, "li")
-    XTree.SubElement(li, "a",{"epub:type": "bodymatter", "href": page[0][0]}).text = "Cover"
-    tree = XTree.ElementTree(root)
-    XTree.indent(tree, space="\t", level=0)
-    tree.write("./" + title + "/toc.xhtml", encoding="utf-8", xml_declaration=True)
-
-
-def generate_toc_ncx(title, page=[]):
-    root = XTree.Element("ncx", {"xmlns": "http://www.daisy.org/z3986/2005/ncx/", "version": "2005-1"})
-    head = XTree.SubElement(root, "head")
-    XTree.SubElement(head, "meta", {"name": "dtb:uid", "content": "9781975336608"})
-    docTitle = XTree.SubElement(root, "docTitle")
-    XTree.SubElement(docTitle, "text").text= title
-    navMap = XTree.SubElement(root, "navMap")
+        lines.append((5, b"<li>"))
+        lines.append((6, b'<a href="%s">%s</a>' % (attribute(site), text(titles))))
+        lines.append((5, b"</li>"))
+    lines += [(4, b"</ol>"),
+              (3, b"</nav>"),
+              (2, b"</section>"),
+              (2, b'<nav epub:type="landmarks">'),
+              (3, b"<ol>"),
+              (4, b"<li>"),
+              (5, b'<a epub:type="bodymatter" href="%s">Cover</a>' % attribute(page[0][0])),
+              (4, b"</li>"),
+              (3, b"</ol>"),
+              (2, b"</nav>"),
+              (1, b"</body>"),
+              (0, b"</html>")]
+    return render(lines, pretty)
+
+
+def generate_toc_html(title, page=[], folder=None, pretty=True):
+    folder = folder or "./" + title
+    with open(folder + "/toc.xhtml", "wb") as f:
+        f.write(toc_html(title, page, pretty))
+
+
+def toc_ncx(title, page=[], pretty=True):
+    lines = [(0, b'<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'),
+             (1, b"<head>"),
+             (2, b'<meta name="dtb:uid" content="9781975336608" />'),
+             (1, b"</head>"),
+             (1, b"<docTitle>"),
+             (2, b"<text>" + text(title) + b"</text>"),
+             (1, b"</docTitle>"),
+             (1, b"<navMap>")]
     for (site, titles) in page:
-        navPoint = XTree.SubElement(navMap, "navPoint")
-        navLabel = XTree.SubElement(navPoint, "navLabel")
-        XTree.SubElement(navLabel, "text").text = titles
-        XTree.SubElement(navPoint, "content", {"src": site})
-    tree = XTree.ElementTree(root)
-    XTree.indent(tree, space="\t", level=0)
-    tree.write("./" + title + "/toc.ncx", encoding="utf-8", xml_declaration=True)
-
-def generate_package_opf(title, genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, format="png"):
-    root = XTree.Element("package", {"xmlns": "http://www.idpf.org/2007/opf", "version": "3.0", "unique-identifier": "uid", "prefix": "ibooks: http://vocabulary.itunes.apple.com/rdf/ibooks/vocabulary-extensions-1.0/"})
-    metadata = XTree.SubElement(root, "metadata", {"xmlns:dc": "http://purl.org/dc/elements/1.1/", "xmlns:opf": "http://www.idpf.org/2007/opf"})
-    XTree.SubElement(metadata, "dc:title", {"id": "id"}).text = title
+        lines += [(2, b"<navPoint>"),
+                  (3, b"<navLabel>"),
+                  (4, b"<text>" + text(titles) + b"</text>"),
+                  (3, b"</navLabel>"),
+                  (3, b'<content src="%s" />' % attribute(site)),
+                  (2, b"</navPoint>")]
+    lines += [(1, b"</navMap>"),
+              (0, b"</ncx>")]
+    return render(lines, pretty)
+
+
+def generate_toc_ncx(title, page=[], folder=None, pretty=True):
+    folder = folder or "./" + title
+    with open(folder + "/toc.ncx", "wb") as f:
+        f.write(toc_ncx(title, page, pretty))
+
+def spine_itemref(idref, count):
+    if count < 2:
+        return (idref, None)
+    elif count % 2 == 1:
+        return (idref, "page-spread-left")
+    return (idref, "page-spread-right")
+
+
+OPF_HEAD = [(0, b'<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid" prefix="ibooks: http://vocabulary.itunes.apple.com/rdf/ibooks/vocabulary-extensions-1.0/">'),
+            (1, b'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">')]
+OPF_LAYOUT = [(2, b'<meta name="book-type" content="comic" />'),
+              (2, b'<meta name="cover" content="cover" />'),
+              (2, b'<meta property="dcterms:modified">2000-03-24T00:00:00Z</meta>'),
+              (2, b'<meta property="rendition:layout">pre-paginated</meta>'),
+              (2, b'<meta name="fixed-layout" content="true" />'),
+              (1, b"</metadata>"),
+              (1, b"<manifest>")]
+MANIFEST_ITEM = b'<item id="%s" href="%s" media-type="%s" />'
+MANIFEST_ITEM_PROPERTIES = b'<item id="%s" href="%s" media-type="%s" properties="%s" />'
+SPINE_ITEMREF = b'<itemref idref="%s" />'
+SPINE_ITEMREF_PROPERTIES = b'<itemref idref="%s" properties="%s" />'
+
+
+def package_opf(title, items, itemrefs, genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, uuids=None, pretty=True):
+    if uuids is None:
+        uuids = (str(uuid4()), str(uuid4()))
+    lines = OPF_HEAD + [(2, b'<dc:title id="id">' + text(title) + b"</dc:title>")]
     if author:
-        XTree.SubElement(metadata, "dc:creator", {"id": "id-1"}).text = author
+        lines.append((2, b'<dc:creator id="id-1">' + text(author) + b"</dc:creator>"))
     if language:
-        XTree.SubElement(metadata, "dc:language").text = language
+        lines.append((2, b"<dc:language>" + text(language) + b"</dc:language>"))
     if publisher:
-        XTree.SubElement(metadata, "dc:publisher").text = publisher
+        lines.append((2, b"<dc:publisher>" + text(publisher) + b"</dc:publisher>"))
     for genre in genres:
-        XTree.SubElement(metadata, "dc:subject").text = genre
+        lines.append((2, b"<dc:subject>" + text(genre) + b"</dc:subject>"))
     if description:
-        XTree.SubElement(metadata, "dc:description").text = description
-    XTree.SubElement(metadata, "dc:identifier").text = "uuid:"+str(uuid4())
-    XTree.SubElement(metadata, "dc:identifier", {"id": "uid"}).text = "urn:uuid:"+str(uuid4())
-    XTree.SubElement(metadata, "opf:meta", {"refines": "#id", "property": "title-type"}).text = "main"
-    XTree.SubElement(metadata, "opf:meta", {"refines": "#id", "property": "file-as"}).text = title
+        lines.append((2, b"<dc:description>" + text(description) + b"</dc:description>"))
+    lines += [(2, b"<dc:identifier>uuid:" + text(uuids[0]) + b"</dc:identifier>"),
+              (2, b'<dc:identifier id="uid">urn:uuid:' + text(uuids[1]) + b"</dc:identifier>"),
+              (2, b'<opf:meta refines="#id" property="title-type">main</opf:meta>'),
+              (2, b'<opf:meta refines="#id" property="file-as">' + text(title) + b"</opf:meta>")]
     if series:
-        XTree.SubElement(metadata, "meta",{"property": "schema:isPartOf"}).text = series
-        XTree.SubElement(metadata, "meta",{"name": "calibre:series", "content": series})
+        lines += [(2, b'<meta property="schema:isPartOf">' + text(series) + b"</meta>"),
+                  (2, b'<meta name="calibre:series" content="%s" />' % attribute(series))]
     if number:
-        XTree.SubElement(metadata, "meta", {"property": "schema:position"}).text = number
-        XTree.SubElement(metadata, "meta",{"name": "calibre:series_index", "content": number})
-    XTree.SubElement(metadata, "meta", {"name": "book-type", "content": "comic"})
-    XTree.SubElement(metadata, "meta", {"name": "cover", "content": "cover"})
-    XTree.SubElement(metadata, "meta", {"property": "dcterms:modified"}).text = "2000-03-24T00:00:00Z"
-    XTree.SubElement(metadata, "meta", {"property": "rendition:layout"}).text = "pre-paginated"
-    XTree.SubElement(metadata, "meta", {"name": "fixed-layout", "content": "true"})
-
-    manifest = XTree.SubElement(root, "manifest")
-    spine = XTree.SubElement(root, "spine", {"page-progression-direction": "rtl"})
-    i=0
-    count = 0
-    for (base, dirs, files) in os.walk(title):
-        sort_files = sorted(files, key=natural_keys)
-        for file in sort_files:
-            if file.endswith(".html") or file.endswith(".xhtml"):
-                if "toc" in file:
-                    XTree.SubElement(manifest, "item", {"id": "toc", "href": file, "media-type": "application/xhtml+xml", "properties": "nav"})
-                    continue
-                else:
-                    XTree.SubElement(manifest, "item", {"id": "id" + str(i), "href": file, "media-type": "application/xhtml+xml", "properties": "scripted"})
-                if count < 2:
-                    XTree.SubElement(spine, "itemref", {"idref": "id" + str(i)})
-                elif count % 2 == 1:
-                    XTree.SubElement(spine, "itemref", {"idref": "id" + str(i), "properties": "page-spread-left"})
-                else:
-                    XTree.SubElement(spine, "itemref", {"idref": "id" + str(i), "properties": "page-spread-right"})
-                count += 1
-                i += 1
-            elif file.endswith(format):
-                if "jpg" != format:
-                    if "image" in base:
-                        XTree.SubElement(manifest, "item", {"id": "id"+str(i), "href": "images/"+file, "media-type": "image/"+format})
-                        i += 1
-                    else:
-                        XTree.SubElement(manifest, "item", {"id": "cover", "href": file, "media-type": "image/"+format})
-                else:
-                    if "image" in base:
-                        XTree.SubElement(manifest, "item", {"id": "id"+str(i), "href": "images/"+file, "media-type": "image/jpeg"})
-                        i += 1
-                    else:
-                        XTree.SubElement(manifest, "item", {"id": "cover", "href": file, "media-type": "image/jpeg"})
-            elif file.endswith("ncx"):
-                XTree.SubElement(manifest, "item", {"id": "toc.ncx", "href": file, "media-type": "application/x-dtbncx+xml"})
-            else:
-                if "css" in base:
-                    XTree.SubElement(manifest, "item", {"id": "id"+str(i), "href": "css/"+file, "media-type": "text/css"})
-                if "js" in base:
-                    XTree.SubElement(manifest, "item",
-                                     {"id": "id" + str(i), "href": "js/" + file, "media-type": "application/javascript"})
-                i += 1
-    tree = XTree.ElementTree(root)
-    XTree.indent(tree, space="\t",level=0)
-    tree.write("./"+title+"/metadata.opf", encoding="utf-8", xml_declaration=True)
-
-
-def genereate_container_xml(title):
-    root = XTree.Element("container", {"xmlns": "urn:oasis:names:tc:opendocument:xmlns:container", "version": "1.0"})
-    files = XTree.SubElement(root, "rootfiles")
-    XTree.SubElement(files, "rootfile", {"full-path": "metadata.opf", "media-type": "application/oebps-package+xml"})
-    if not os.path.exists("./"+title+"/META-INF"):
-        os.mkdir("./"+title+"/META-INF")
-    tree = XTree.ElementTree(root)
-    XTree.indent(tree,space="\t", level=0)
-    tree.write("./"+title+"/META-INF/container.xml", encoding="utf-8", xml_declaration=True)
-
-
-def e_pub_zip(file_name, folder):
+        lines += [(2, b'<meta property="schema:position">' + text(number) + b"</meta>"),
+                  (2, b'<meta name="calibre:series_index" content="%s" />' % attribute(number))]
+    lines += OPF_LAYOUT
+    for (identifier, href, media, properties) in items:
+        if properties:
+            lines.append((2, MANIFEST_ITEM_PROPERTIES % (attribute(identifier), attribute(href), attribute(media), attribute(properties))))
+        else:
+            lines.append((2, MANIFEST_ITEM % (attribute(identifier), attribute(href), attribute(media))))
+    lines += [(1, b"</manifest>"),
+              (1, b'<spine page-progression-direction="rtl">')]
+    for (idref, properties) in itemrefs:
+        if properties:
+            lines.append((2, SPINE_ITEMREF_PROPERTIES % (attribute(idref), attribute(properties))))
+        else:
+            lines.append((2, SPINE_ITEMREF % attribute(idref)))
+    lines += [(1, b"</spine>"),
+              (0, b"</package>")]
+    return render(lines, pretty)
+
+
+def generate_package_opf(title, genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, format="png", folder=None, index=None, pretty=True):
+    folder = folder or "./" + title
+    index = index or PageIndex(folder, format)
+    items, itemrefs = index.manifest()
+    with open(folder+"/metadata.opf", "wb") as f:
+        f.write(package_opf(title, items, itemrefs, genres, author, language, publisher, description, series, number, pretty=pretty))
+
+
+CONTAINER = [(0, b'<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">'),
+             (1, b"<rootfiles>"),
+             (2, b'<rootfile full-path="metadata.opf" media-type="application/oebps-package+xml" />'),
+             (1, b"</rootfiles>"),
+             (0, b"</container>")]
+
+
+def container_xml(pretty=True):
+    return render(CONTAINER, pretty)
+
+
+def genereate_container_xml(title, folder=None, pretty=True):
+    folder = folder or "./" + title
+    if not os.path.exists(folder+"/META-INF"):
+        os.mkdir(folder+"/META-INF")
+    with open(folder+"/META-INF/container.xml", "wb") as f:
+        f.write(container_xml(pretty))
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+
+def member_compression(name):
+    # images are already compressed and mimetype must be stored, deflate everything else
+    if name == "mimetype" or name.lower().endswith(IMAGE_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def e_pub_zip(file_name, folder, compresslevel=6, compression=member_compression):
     with zipfile.ZipFile(file_name, 'w') as myzip:
-        myzip.writestr('mimetype', 'application/epub+zip')
-    with zipfile.ZipFile(file_name, 'a') as myzip:
+        myzip.writestr('mimetype', 'application/epub+zip', compress_type=compression('mimetype'))
         for base, dirs, files in os.walk(folder):
+            # hidden entries like the .epub-cache.json of --incremental are not part of the book
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
             for ifile in files:
+                if ifile.startswith("."):
+                    continue
                 fn = os.path.join(base, ifile)
-                myzip.write(fn, fn.replace(folder+"\\", "").replace(folder+"/", ""))
+                name = fn.replace(folder+"\\", "").replace(folder+"/", "")
+                myzip.write(fn, name, compress_type=compression(name), compresslevel=compresslevel)
 
 
-def generate_structure(path, start, format="png"):
-    for base, dirs, files in os.walk(path):
-        for file in files:
-            if not file.endswith("."+format) or "Cover" in file:
-                continue
-            name = file.replace("."+format, "")
-            if start in file:
-                copyfile(path+"/"+file, path+"/Cover."+format)
-            if not os.path.exists(path+"/images"):
-                os.mkdir(path+"/images")
-                os.mkdir(path+"/css")
-                os.mkdir(path+"/js")
-                with open(path + "/css/reset.css", "w", encoding="utf-8") as f:
-                    f.write(
-                        "/* http://meyerweb.com/eric/tools/css/reset/\nv2.0 | 20110126\nLicense: none (public domain)\n*/\nhtml, body, div, span, applet, object, iframe,h1, h2, h3, h4, h5, h6, p, blockquote, pre, a, abbr, acronym, address, big, cite, code, del, dfn, em, img, ins, kbd, q, s, samp, small, strike, strong, sub, sup, tt, var, b, u, i, center, dl, dt, dd, ol, ul, li, fieldset, form, label, legend, table, caption, tbody, tfoot, thead, tr, th, td, article, aside, canvas, details, embed,  figure, figcaption, footer, header, hgroup,  menu, nav, output, ruby, section, summary, time, mark, audio, video {\nmargin: 0;\npadding: 0;\nborder: 0;\nfont-size: 100%;\nfont: inherit;\nvertical-align: baseline;\n}\na { color: black; text-decoration: none; }\n/* HTML5 display-role reset for older browsers */\narticle, aside, details, figcaption, figure, footer, header, hgroup, menu, nav, section {\ndisplay: block;\n}\nbody { line-height: 1; }\nol, ul { list-style: none; }\nblockquote, q { quotes: none; }\nblockquote:before, blockquote:after, q:before, q:after {\ncontent: "";\ncontent: none;\n}\ntable {\nborder-collapse: collapse;\nborder-spacing: 0;\n}")
-                with open(path + "/css/styles.css", "w", encoding="utf-8") as f:
-                    f.write(
-                        "body { width: 100%; height: 100%; }\nimg.full { height: 100%; top: 0; left: 0; z-index: -1; }\n\n@media amzn-kf8\n{\n\tbody { width: auto; height: auto; }\n\timg.full { width: auto; height : auto; top : auto; left : auto;}\n}\n\nsvg {\n\tposition:absolute;\n\ttop:0;\n\tleft:0;\n\tmargin:0;\n\tpadding:0;\n\theight:100% !important;\n\tmax-width:100% !important;\n}")
-                with open(path + "/css/stylesheet.css", "w", encoding="utf-8") as f:
-                    f.write('@import url("reset.css");\n@import url("styles.css");')
-                with open(path+"/js/kobo.js", "w", encoding="utf-8") as f:
-                    f.write("var gPosition = 0;\nvar gProgress = 0;\nvar gCurrentPage = 0;\nvar gPageCount = 0;\nvar gClientHeight = null;\n\nconst kMaxFont = 0;\n\nfunction getPosition()\n{\n\treturn gPosition;\n}\n\nfunction getProgress()\n{\n\treturn gProgress;\n}\n\nfunction getPageCount()\n{\n\treturn gPageCount;\n}\n\nfunction getCurrentPage()\n{\n\treturn gCurrentPage;\n}\n\n/**\n * Setup the columns and calculate the total page count;\n */\n\nfunction setupBookColumns()\n{\n\tvar body = document.getElementsByTagName('body')[0].style;\n\tbody.marginLeft = 0;\n\tbody.marginRight = 0;\n\tbody.marginTop = 0;\n\tbody.marginBottom = 0;\n\t\n    var bc = document.getElementById('book-columns').style;\n    bc.width = (window.innerWidth * 2) + 'px !important';\n\tbc.height = (window.innerHeight-kMaxFont) + 'px !important';\n    bc.marginTop = '0px !important';\n    bc.webkitColumnWidth = window.innerWidth + 'px !important';\n    bc.webkitColumnGap = '0px';\n\tbc.overflow = 'visible';\n\n\tgCurrentPage = 1;\n\tgProgress = gPosition = 0;\n\t\n\tvar bi = document.getElementById('book-inner').style;\n\tbi.marginLeft = '0px';\n\tbi.marginRight = '0px';\n\tbi.padding = '0';\n\n\tgPageCount = document.body.scrollWidth / window.innerWidth;\n\n\t// Adjust the page count to 1 in case the initial bool-columns.clientHeight is less than the height of the screen. We only do this once.2\n\n\tif (gClientHeight < (window.innerHeight-kMaxFont)) {\n\t\tgPageCount = 1;\n\t}\n}\n\n/**\n * Columnize the document and move to the first page. The position and progress are reset/initialized\n * to 0. This should be the initial pagination request when the document is initially shown.\n */\n\nfunction paginate()\n{\t\n\t// Get the height of the page. We do this only once. In setupBookColumns we compare this\n\t// value to the height of the window and then decide wether to force the page count to one.\n\t\n\tif (gClientHeight == undefined) {\n\t\tgClientHeight = document.getElementById('book-columns').clientHeight;\n\t}\n\t\n\tsetupBookColumns();\n}\n\n/**\n * Paginate the document again and maintain the current progress. This needs to be used when\n * the content view changes size. For example because of orientation changes. The page count\n * and current page are recalculated based on the current progress.\n */\n\nfunction paginateAndMaintainProgress()\n{\n\tvar savedProgress = gProgress;\n\tsetupBookColumns();\n\tgoProgress(savedProgress);\n}\n\n/**\n * Update the progress based on the current page and page count. The progress is calculated\n * based on the top left position of the page. So the first page is 0% and the last page is\n * always below 1.0.\n */\n\nfunction updateProgress()\n{\n\tgProgress = (gCurrentPage - 1.0) / gPageCount;\n}\n\n/**\n * Move a page back if possible. The position, progress and page count are updated accordingly.\n */\n\nfunction goBack()\n{\n\tif (gCurrentPage > 1)\n\t{\n\t\tgCurrentPage--;\n\t\tgPosition -= window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Move a page forward if possible. The position, progress and page count are updated accordingly.\n */\n\nfunction goForward()\n{\n\tif (gCurrentPage < gPageCount)\n\t{\n\t\tgCurrentPage++;\n\t\tgPosition += window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Move directly to a page. Remember that there are no real page numbers in a reflowed\n * EPUB document. Use this only in the context of the current document.\n */\n\nfunction goPage(pageNumber)\n{\n\tif (pageNumber > 0 && pageNumber <= gPageCount)\n\t{\n\t\tgCurrentPage = pageNumber;\n\t\tgPosition = (gCurrentPage - 1) * window.innerWidth;\n\t\twindow.scrollTo(gPosition, 0);\n\t\tupdateProgress();\n\t}\n}\n\n/**\n * Go the the page with respect to progress. Assume everything has been setup.\n */\n\nfunction goProgress(progress)\n{\n\tprogress += 0.0001;\n\t\n\tvar progressPerPage = 1.0 / gPageCount;\n\tvar newPage = 0;\n\t\n\tfor (var page = 0; page < gPageCount; page++) {\n\t\tvar low = page * progressPerPage;\n\t\tvar high = low + progressPerPage;\n\t\tif (progress >= low && progress < high) {\n\t\t\tnewPage = page;\n\t\t\tbreak;\n\t\t}\n\t}\n\t\t\n\tgCurrentPage = newPage + 1;\n\tgPosition = (gCurrentPage - 1) * window.innerWidth;\n\twindow.scrollTo(gPosition, 0);\n\tupdateProgress();\t\t\n}\n\n//Set font family\nfunction setFontFamily(newFont) {\n\tdocument.body.style.fontFamily = newFont + ' !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Sets font size to a relative size\nfunction setFontSize(toSize) {\n\tdocument.getElementById('book-inner').style.fontSize = toSize + 'em !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Sets line height relative to font size\nfunction setLineHeight(toHeight) {\n\tdocument.getElementById('book-inner').style.lineHeight = toHeight + 'em !important';\n\tpaginateAndMaintainProgress();\n}\n\n//Enables night reading mode\nfunction enableNightReading() {\n\tdocument.body.style.backgroundColor = '#000000';\n\tvar theDiv = document.getElementById('book-inner');\n\ttheDiv.style.color = '#ffffff';\n\t\n\tvar anchorTags;\n\tanchorTags = theDiv.getElementsByTagName('a');\n\t\n\tfor (var i = 0; i < anchorTags.length; i++) {\n\t\tanchorTags[i].style.color = '#ffffff';\n\t}\n}")
-            os.rename(path+"/"+file,path+"/images/"+file)
-            img = Image.open(path+"/images/"+file)
-            with open(path+"/"+name+".xhtml", "w", encoding="utf-8") as f:
-                f.write(
-                    '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<meta name="viewport" content="width=984, height=1429"/>\n<title>' + path + '</title>\n<link href="css/stylesheet.css" type="text/css" rel="stylesheet"/>\n\n<!-- kobo-style -->\n<script xmlns="http://www.w3.org/1999/xhtml" type="text/javascript" src="js/kobo.js"/>\n\n</head>\n<body>\n\n<div class="even">\n<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" width="'+str(img.width)+'" height="'+str(img.height)+'" viewBox="0 0 '+str(img.width)+' '+str(img.height)+'">\n\t<image width="'+str(img.width)+'" height="'+str(img.height)+'" xlink:href="images/' + name + '.'+format+'"/>\n</svg>\n\n</div>\n</body>\n</html>')
-            img.close()
-        break
-    print(path+" competed!")
+PAGE_XHTML = b'<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<meta name="viewport" content="width=%d, height=%d"/>\n<title>%s</title>\n<link href="css/stylesheet.css" type="text/css" rel="stylesheet"/>\n\n<!-- kobo-style -->\n<script xmlns="http://www.w3.org/1999/xhtml" type="text/javascript" src="js/kobo.js"/>\n\n</head>\n<body>\n\n<div class="even">\n<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" width="%d" height="%d" viewBox="0 0 %d %d">\n\t<image width="%d" height="%d" xlink:href="images/%s"/>\n</svg>\n\n</div>\n</body>\n</html>'
+
+
+def page_xhtml(title, image, width, height, viewport=(984, 1429)):
+    return PAGE_XHTML % (viewport[0], viewport[1], text(title), width, height, width, height, width, height, attribute(image))
+
+
+def io_counters():
+    # Linux adds the counters of reaped children to their parent, pool_map joins its workers, so their I/O is included
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def worker_peak_rss():
+    # the largest peak of all reaped children so far, not of the current stage
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Stats:
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        try:
+            # reset the peak RSS of this process (Linux only), so VmHWM is the peak of this stage
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        (read, written) = io_counters()
+        workers = worker_peak_rss()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - begin
+            (read_after, written_after) = io_counters()
+            workers_after = worker_peak_rss()
+            self.stages.append({"stage": name, "seconds": elapsed,
+                                "read": read_after - read if read is not None else None,
+                                "written": written_after - written if written is not None else None,
+                                "peak_rss": peak_rss(),
+                                # only a stage whose workers raised the lifetime maximum can be attributed a worker peak
+                                "worker_peak_rss": workers_after if workers is not None and workers_after > workers else None})
+
+    def report(self, format="text"):
+        if format == "json":
+            return json.dumps({"stages": self.stages, "seconds": sum(stage["seconds"] for stage in self.stages)}, indent="\t")
+        lines = ["%-12s %9s %12s %12s %10s %10s" % ("stage", "seconds", "read", "written", "peak rss", "workers")]
+        for stage in self.stages:
+            lines.append("%-12s %9.3f %12s %12s %10s %10s" % (stage["stage"], stage["seconds"], human_bytes(stage["read"]), human_bytes(stage["written"]), human_bytes(stage["peak_rss"]), human_bytes(stage["worker_peak_rss"])))
+        lines.append("%-12s %9.3f" % ("total", sum(stage["seconds"] for stage in self.stages)))
+        return "\n".join(lines)
+
+
+def human_bytes(count):
+    if count is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return "%d %s" % (count, unit) if unit == "B" else "%.1f %s" % (count, unit)
+        count /= 1024
+    return "%.1f GiB" % count
+
+
+# set to a Stats instance to collect the wall time, I/O and memory of every stage
+STATS = None
+
+
+def stage(name):
+    return STATS.stage(name) if STATS else nullcontext()
+
+
+def pool_map(function, jobs, *iterables):
+    if jobs > 1:
+        count = len(iterables[0])
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(function, *iterables, chunksize=max(1, count // (jobs * 4))))
+    return list(map(function, *iterables))
+
+
+def generate_page(path, page, title=None):
+    image = path+"/images/"+page.file
+    if page.path != image:
+        os.rename(page.path, image)
+    width, height = image_size(image)
+    with open(path+"/"+page.name+".xhtml", "wb") as f:
+        f.write(page_xhtml(title or path, page.file, width, height))
+
+
+def generate_structure(path, start, format="png", jobs=1, title=None, index=None):
+    begin = time.perf_counter()
+    index = index or PageIndex(path, format)
+    pages = index.pages
+    for page in pages:
+        if page.name == start:
+            copyfile(page.path, path+"/Cover."+format)
+    if pages and not os.path.exists(path+"/images"):
+        os.mkdir(path+"/images")
+        os.mkdir(path+"/css")
+        os.mkdir(path+"/js")
+        for (name, data) in ASSETS:
+            with open(path + "/" + name, "w", encoding="utf-8") as f:
+                f.write(data)
+    pool_map(generate_page, jobs, [path] * len(pages), pages, [title] * len(pages))
+    elapsed = time.perf_counter() - begin
+    print(path+" competed! (%d pages, %.1f pages/s)" % (len(pages), len(pages) / elapsed if elapsed else 0))
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_info(path, cached=None):
+    stat = os.stat(path)
+    if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+        return cached
+    digest = file_hash(path)
+    if cached and cached["hash"] == digest:
+        width, height = cached["width"], cached["height"]
+    else:
+        width, height = image_size(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest, "width": width, "height": height}
+
+
+def load_cache(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def reusable_members(file_name, cache, members):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return 0
+    if cache.get("epub") != [stat.st_size, stat.st_mtime_ns]:
+        return 0
+    count = 0
+    for (member, cached) in zip(members, cache.get("members", [])):
+        if member != cached:
+            break
+        count += 1
+    return count
+
+
+def zip_truncate(myzip, index):
+    # zipfile cannot drop members, so forget everything from index on and let the next write start at its local header
+    infos = myzip.infolist()
+    myzip.start_dir = infos[index].header_offset
+    for info in infos[index:]:
+        del myzip.NameToInfo[info.filename]
+    del myzip.filelist[index:]
+    myzip._didModify = True
+
+
+# width, height and grayscale of the screen the pages are optimised for
+PROFILES = {
+    "kobo-clara": (1072, 1448, True),
+    "kobo-libra": (1264, 1680, True),
+    "kobo-elipsa": (1404, 1872, True),
+    "kindle-paperwhite": (1236, 1648, True),
+    "kindle-oasis": (1264, 1680, True),
+    "kindle-scribe": (1860, 2480, True),
+    "tablet": (1536, 2048, False),
+}
+ENCODINGS = {"jpg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+
+def optimise_page(path, cache_dir, settings, digest=None, archive=None):
+    (width, height, grayscale, encoding, quality, colors) = settings
+    digest = digest or file_hash(path)
+    output = cache_dir+"/"+digest+"."+encoding
+    if os.path.exists(output):
+        return (output,) + tuple(image_size(output))
+    from PIL import Image
+    with open_image(path, archive) as fp, Image.open(fp) as img:
+        mode = "L" if grayscale else "RGB"
+        img.draft(mode, (width, height))
+        img = img.convert(mode)
+        img.thumbnail((width, height), Image.LANCZOS)
+        if colors:
+            img = img.quantize(colors)
+            if encoding != "png":
+                img = img.convert(mode)
+        # identical pages share one cache file, so every worker encodes into its own part file
+        part = output+".%d.part" % os.getpid()
+        if encoding == "png":
+            img.save(part, ENCODINGS[encoding], optimize=True)
+        else:
+            img.save(part, ENCODINGS[encoding], quality=quality)
+        size = img.size
+    os.replace(part, output)
+    return (output,) + size
+
+
+def stream_epub(file_name, title, start, page=[], genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, format="png", jobs=1, compresslevel=6, incremental=False, folder=None, profile=None, encoding="jpg", quality=85, colors=0, index=None, pretty=True):
+    begin = time.perf_counter()
+    folder = folder or "./" + title
+    if index is None:
+        with stage("index"):
+            index = PageIndex(folder, format)
+    files = [entry.file for entry in index]
+    paths = [entry.path for entry in index]
+    archive = index.archive
+    if incremental and archive:
+        raise ValueError("incremental builds need a title folder, not an archive")
+    if archive and not files:
+        raise ValueError("no ."+format+" pages in "+archive)
+    cache_file = folder+"/.epub-cache.json"
+    cache = load_cache(cache_file) if incremental else {}
+    with stage("probe"):
+        if incremental:
+            cached = cache.get("pages", {})
+            infos = pool_map(page_info, jobs, paths, [cached.get(file) for file in files])
+            sizes = [(info["width"], info["height"]) for info in infos]
+            page_hashes = [info["hash"] for info in infos]
+        elif not profile:
+            sizes = pool_map(image_size, jobs, paths, [archive] * len(paths))
+    sources = paths
+    viewport = (984, 1429)
+    if profile:
+        (width, height, grayscale) = PROFILES[profile]
+        key = "%s-%s-q%d-c%d" % (profile, encoding, quality, colors)
+        # next to the title folder or archive, so the input stays untouched and directory builds do not pack the cache
+        cache_dir = folder.rstrip("/\\")+".epub-cache/"+key
+        os.makedirs(cache_dir, exist_ok=True)
+        settings = (width, height, grayscale, encoding, quality, colors)
+        if not incremental:
+            page_hashes = [entry.digest for entry in index]
+        with stage("optimise"):
+            results = pool_map(optimise_page, jobs, paths, [cache_dir] * len(paths), [settings] * len(paths), page_hashes, [archive] * len(paths))
+        sources = [result[0] for result in results]
+        sizes = [result[1:] for result in results]
+        viewport = (width, height)
+        if incremental:
+            page_hashes = [digest+"@"+key for digest in page_hashes]
+    with stage("documents"):
+        items, itemrefs = index.manifest(encoding if profile else None)
+        if not profile:
+            encoding = format
+        images = [entry.name+"."+encoding for entry in index]
+        uuids = cache.get("uuids") or [str(uuid4()), str(uuid4())]
+
+        # members are ordered from the most to the least stable, so an incremental build only rewrites the tail
+        members = [("mimetype", b"application/epub+zip", None), ("META-INF/container.xml", container_xml(pretty), None)]
+        for (name, data) in ASSETS:
+            members.append((name, data.encode("utf-8"), None))
+        for (entry, image, source) in zip(index, images, sources):
+            members.append(("images/"+image, None, source))
+            if entry.name == start:
+                members.append(("Cover."+encoding, None, source))
+        for (entry, image, (width, height)) in zip(index, images, sizes):
+            members.append((entry.name+".xhtml", page_xhtml(title, image, width, height, viewport), None))
+        members.append(("toc.xhtml", toc_html(title, page, pretty), None))
+        members.append(("toc.ncx", toc_ncx(title, page, pretty), None))
+        members.append(("metadata.opf", package_opf(title, items, itemrefs, genres, author, language, publisher, description, series, number, uuids, pretty), None))
+
+    keep = 0
+    if incremental:
+        hashes = dict(zip(sources, page_hashes))
+        digests = [[name, hashes[path] if path else hashlib.sha1(data).hexdigest()] for (name, data, path) in members]
+        if cache.get("compresslevel") == compresslevel:
+            keep = reusable_members(file_name, cache, digests)
+    if keep == len(members) == len(cache["members"]):
+        rewritten = 0
+    else:
+        try:
+            if keep:
+                myzip = zipfile.ZipFile(file_name, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+                if keep < len(myzip.infolist()):
+                    zip_truncate(myzip, keep)
+            else:
+                # build next to the target and rename at the end, so an interrupted run leaves no half-written epub behind
+                myzip = zipfile.ZipFile(file_name+".part", 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+            with stage("zip"), myzip:
+                for (name, data, path) in members[keep:]:
+                    if path and archive and not profile:
+                        # copy the page straight from the source archive, it is stored and never extracted to disk
+                        source = open_archive(archive).getinfo(path)
+                        info = zipfile.ZipInfo(name, time.localtime()[:6])
+                        info.compress_type = member_compression(name)
+                        info.file_size = source.file_size
+                        info.external_attr = 0o600 << 16
+                        with open_image(path, archive) as fp, myzip.open(info, "w") as out:
+                            copyfileobj(fp, out, 1 << 20)
+                    elif path:
+                        myzip.write(path, name, compress_type=member_compression(name))
+                    else:
+                        myzip.writestr(name, data, compress_type=member_compression(name))
+        except BaseException:
+            # closing the zip still wrote a central directory, an epub appended to in place is missing its tail,
+            # so drop it together with its cache and let the next run build from scratch
+            for path in (file_name, cache_file) if keep else (file_name+".part",):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        if not keep:
+            os.replace(file_name+".part", file_name)
+        rewritten = len(members) - keep
+    if incremental:
+        stat = os.stat(file_name)
+        with open(cache_file, "w", encoding="utf-8") as f:
+            json.dump({"uuids": uuids, "compresslevel": compresslevel, "pages": dict(zip(files, infos)),
+                       "members": digests, "epub": [stat.st_size, stat.st_mtime_ns]}, f)
+    elapsed = time.perf_counter() - begin
+    print(file_name+" competed! (%d pages, %d of %d members written, %.1f pages/s)" % (len(files), rewritten, len(members), len(files) / elapsed if elapsed else 0))
+    return len(files), rewritten, elapsed
+
+
+def directory_epub(file_name, title, start, page=[], genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, format="png", jobs=1, compresslevel=6, folder=None, index=None, pretty=True):
+    folder = folder or "./" + title
+    with stage("clean"):
+        try:
+            path = os.path.join(folder, "META-INF")
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                for file in filenames:
+                    os.remove(os.path.join(dirpath, file))
+            os.removedirs(path)
+            os.remove(folder+"/metadata.opf")
+        except Exception:
+            pass
+    if index is None:
+        with stage("index"):
+            index = PageIndex(folder, format)
+    with stage("structure"):
+        generate_structure(folder, start, format=format, jobs=jobs, title=title, index=index)
+    with stage("toc"):
+        generate_toc_html(title, page, folder, pretty)
+        generate_toc_ncx(title, page, folder, pretty)
+    with stage("opf"):
+        generate_package_opf(title, genres, author, language, publisher, description, series, number, format=format, folder=folder, index=index, pretty=pretty)
+        genereate_container_xml(title, folder, pretty)
+    with stage("zip"):
+        e_pub_zip(file_name, folder, compresslevel)
+
+
+def toc_pages(start, marker_index=[], marker_title=[]):
+    pages = []
+    if start+".xhtml" not in marker_index:
+        pages.append((start+".xhtml", "Cover"))
+    for i in range(len(marker_index)):
+        pages.append((marker_index[i], marker_title[i]))
+    return pages
+
+
+VOLUME_OPTIONS = ["lang", "author", "genre", "marker_index", "marker_title", "publisher", "description", "series", "number", "format", "jobs", "compresslevel", "incremental", "output", "profile", "encoding", "quality", "colors", "compact", "stats"]
+MULTI_OPTIONS = ["genre", "marker_index", "marker_title"]
+INT_OPTIONS = ["jobs", "compresslevel", "quality", "colors"]
+FLAG_OPTIONS = ["incremental", "compact"]
+
+
+def manifest_value(key, value):
+    # csv has no types and json / toml may quote them, so numbers and flags are parsed like their command line options
+    if key in INT_OPTIONS:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            return int(value)
+        raise ValueError(key+" must be a number, not "+repr(value))
+    if key in FLAG_OPTIONS:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ("1", "true", "yes", "on"):
+            return True
+        if str(value).lower() in ("0", "false", "no", "off"):
+            return False
+        raise ValueError(key+" must be true or false, not "+repr(value))
+    return value
+
+
+def read_manifest(file_name, defaults={}):
+    if file_name.endswith(".json"):
+        with open(file_name, encoding="utf-8") as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries["volume"]
+    elif file_name.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("TOML manifests need Python 3.11+")
+        with open(file_name, "rb") as f:
+            entries = tomllib.load(f)["volume"]
+    else:
+        with open(file_name, newline="", encoding="utf-8") as f:
+            entries = [dict((key, value) for (key, value) in row.items() if value) for row in csv.DictReader(f)]
+        for entry in entries:
+            for key in MULTI_OPTIONS:
+                if key in entry:
+                    entry[key] = entry[key].split("|")
+    base = os.path.dirname(os.path.abspath(file_name))
+    volumes = []
+    for (i, entry) in enumerate(entries):
+        if not entry.get("title"):
+            raise ValueError("volume %d has no title" % (i + 1))
+        volume = dict(defaults, **dict((key, manifest_value(key, value)) for (key, value) in entry.items()))
+        for key in MULTI_OPTIONS:
+            if isinstance(volume.get(key), str):
+                volume[key] = [volume[key]]
+        if volume.get("number"):
+            volume["number"] = str(volume["number"])
+        volume["folder"] = os.path.join(base, volume.get("folder", volume["title"]))
+        volumes.append(volume)
+    return volumes
+
+
+def build_volume(volume):
+    global STATS
+    STATS = Stats() if volume.get("stats") else None
+    try:
+        if len(volume["marker_index"]) != len(volume["marker_title"]):
+            raise ValueError("same amount of marker-index and marker-title requiered!")
+        with stage("index"):
+            index = PageIndex(volume["folder"], volume["format"])
+        pages = toc_pages(index.start, volume["marker_index"], volume["marker_title"])
+        return (volume["title"],) + stream_epub(os.path.join(volume["output"], volume["title"]+".epub"), volume["title"], index.start, pages, volume["genre"], volume["author"], volume["lang"], volume["publisher"], volume["description"], volume["series"], volume["number"], format=volume["format"], jobs=volume["jobs"], compresslevel=volume["compresslevel"], incremental=volume["incremental"], folder=volume["folder"], index=index, profile=volume["profile"], encoding=volume["encoding"], quality=volume["quality"], colors=volume["colors"], pretty=not volume["compact"]) + (None,)
+    except Exception as e:
+        return volume["title"], 0, 0, 0, str(e)
+    finally:
+        if STATS:
+            print(volume["title"]+"\n"+STATS.report(volume["stats"]))
+
+
+def batch_epub(volumes, jobs=1):
+    begin = time.perf_counter()
+    results = pool_map(build_volume, jobs, volumes)
+    elapsed = time.perf_counter() - begin
+    print("%-50s %6s %8s %9s %9s" % ("title", "pages", "written", "seconds", "pages/s"))
+    for (title, pages, rewritten, seconds, error) in results:
+        if error:
+            print("%-50s failed: %s" % (title, error))
+        else:
+            print("%-50s %6d %8d %9.2f %9.1f" % (title, pages, rewritten, seconds, pages / seconds if seconds else 0))
+    pages = sum(result[1] for result in results)
+    print("%d volumes, %d pages in %.2f s (%.1f pages/s)" % (len(results), pages, elapsed, pages / elapsed if elapsed else 0))
+    return all(result[4] is None for result in results)
 
 
 if __name__ == "__main__":
@@ -258,33 +950,118 @@ if __name__ == "__main__":
                       default="png",
                       const="jpeg",
                       help="Image format (Default PNG)")
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=1,
+                      help="Number of worker processes for page generation (Default 1)")
+    parser.add_option("--stream",
+                      action="store_true",
+                      dest="stream",
+                      default=False,
+                      help="write the Epub straight from the source images without changing the title folder")
+    parser.add_option("-z", "--compress-level",
+                      action="store",
+                      type="int",
+                      dest="compresslevel",
+                      default=6,
+                      help="deflate level 0-9 for text members, images are always stored (Default 6)")
+    parser.add_option("--incremental",
+                      action="store_true",
+                      dest="incremental",
+                      default=False,
+                      help="like --stream, but cache page data in the title folder and only rewrite what changed since the last build")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      dest="output",
+                      default=".",
+                      help="directory the Epub is written to (Default current directory)")
+    parser.add_option("-b", "--batch",
+                      action="store",
+                      dest="batch",
+                      default=False,
+                      help="build every volume of a JSON, TOML or CSV manifest, the other options are used as defaults")
+    parser.add_option("--volumes",
+                      action="store",
+                      type="int",
+                      dest="volumes",
+                      default=1,
+                      help="Number of volumes built in parallel in batch mode (Default 1)")
+    parser.add_option("--profile",
+                      action="store",
+                      type="choice",
+                      choices=sorted(PROFILES),
+                      dest="profile",
+                      default=None,
+                      help="resize and re-encode the pages for a device: " + " / ".join(sorted(PROFILES)) + " (implies --stream)")
+    parser.add_option("--encode",
+                      action="store",
+                      type="choice",
+                      choices=sorted(ENCODINGS),
+                      dest="encoding",
+                      default="jpg",
+                      help="image format of optimised pages: jpg (default) / webp / png")
+    parser.add_option("--quality",
+                      action="store",
+                      type="int",
+                      dest="quality",
+                      default=85,
+                      help="jpg / webp quality of optimised pages (Default 85)")
+    parser.add_option("--colors",
+                      action="store",
+                      type="int",
+                      dest="colors",
+                      default=0,
+                      help="quantise optimised pages to this many colors, e.g. 16 for e-ink (Default off)")
+    parser.add_option("--compact",
+                      action="store_true",
+                      dest="compact",
+                      default=False,
+                      help="write TOC, NCX, OPF and container.xml without indentation")
+    parser.add_option("--stats",
+                      action="store",
+                      type="choice",
+                      choices=["text", "json"],
+                      dest="stats",
+                      default=None,
+                      help="report wall time, bytes read / written and peak RSS of every stage as text or json")
+    parser.add_option("--archive",
+                      action="store",
+                      dest="archive",
+                      default=None,
+                      help="read the pages from a CBZ / ZIP archive instead of the title folder, the title defaults to the archive name (implies --stream)")
     (options, args) = parser.parse_args()
+    options.stream = options.stream or options.incremental or bool(options.profile) or bool(options.archive)
+    if options.archive:
+        options.title = options.title or os.path.splitext(os.path.basename(options.archive))[0]
     if len(options.marker_index) != len(options.marker_title):
         print("same amount of marker-index and marker-title requiered!")
         exit(-1)
-    if options.title:
+    if options.archive and options.incremental:
+        print("--incremental needs a title folder, it can not be combined with --archive!")
+        exit(-1)
+    if options.batch:
         try:
-            path = os.path.join("./" + options.title, "META-INF")
-            for (dirpath, dirnames, filenames) in os.walk(path):
-                for file in filenames:
-                    os.remove(os.path.join(dirpath, file))
-            os.removedirs(path)
-            os.remove("./"+options.title+"/metadata.opf")
-        except Exception:
-            pass
-        options.start = "000"
-        for (base, dirs, files) in os.walk(options.title):
-            sort_files = sorted(files, key=natural_keys)
-            options.start = sort_files[0].replace("."+options.format, "")
-            break
-        pages = []
-        if options.start+".xhtml" not in options.marker_index:
-            pages.append((options.start+".xhtml", "Cover"))
-        for i in range(len(options.marker_index)):
-            pages.append((options.marker_index[i], options.marker_title[i]))
-        generate_structure(options.title, options.start , format=options.format)
-        generate_toc_html(options.title,pages)
-        generate_toc_ncx(options.title, pages)
-        generate_package_opf(options.title, options.genre, options.author, options.lang, options.publisher, options.description, options.series, options.number, format=options.format)
-        genereate_container_xml(options.title)
-        e_pub_zip(options.title+".epub", options.title)
+            volumes = read_manifest(options.batch, dict((key, getattr(options, key)) for key in VOLUME_OPTIONS))
+        except (OSError, ValueError, KeyError) as e:
+            print("invalid manifest "+options.batch+": "+str(e))
+            exit(-1)
+        exit(0 if batch_epub(volumes, options.volumes) else 1)
+    if options.title:
+        if options.stats:
+            STATS = Stats()
+        with stage("index"):
+            index = PageIndex(options.archive or options.title, options.format)
+        if options.archive and not len(index):
+            print("no ."+options.format+" pages in "+options.archive+"!")
+            exit(-1)
+        options.start = index.start
+        pages = toc_pages(options.start, options.marker_index, options.marker_title)
+        file_name = os.path.join(options.output, options.title+".epub")
+        if options.stream:
+            stream_epub(file_name, options.title, options.start, pages, options.genre, options.author, options.lang, options.publisher, options.description, options.series, options.number, format=options.format, jobs=options.jobs, compresslevel=options.compresslevel, incremental=options.incremental, profile=options.profile, encoding=options.encoding, quality=options.quality, colors=options.colors, folder=options.archive, index=index, pretty=not options.compact)
+        else:
+            directory_epub(file_name, options.title, options.start, pages, options.genre, options.author, options.lang, options.publisher, options.description, options.series, options.number, format=options.format, jobs=options.jobs, compresslevel=options.compresslevel, index=index, pretty=not options.compact)
+        if STATS:
+            print(STATS.report(options.stats))
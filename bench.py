@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import zipfile
+import shutil
+import tempfile
+import xml.etree.ElementTree as XTree
+from optparse import OptionParser
+from PIL import Image
+
+import Epub
+
+
+POLICIES = [
+    ("stored", lambda name: zipfile.ZIP_STORED),
+    ("deflated", lambda name: zipfile.ZIP_DEFLATED),
+    ("mixed", Epub.member_compression),
+]
+
+
+def generate_pages(path, count, width, height, format="png"):
+    os.makedirs(path, exist_ok=True)
+    for i in range(count):
+        img = Image.merge("RGB", [Image.effect_noise((width, height), 32 + i % 32)] * 3)
+        img.save(os.path.join(path, "%03d.%s" % (i, format)))
+        img.close()
+
+
+def bench_zip(folder, repeat=3, compresslevel=6):
+    results = []
+    for (name, policy) in POLICIES:
+        best = None
+        for _ in range(repeat):
+            file_name = folder + "." + name + ".epub"
+            begin = time.process_time()
+            Epub.e_pub_zip(file_name, folder, compresslevel, policy)
+            elapsed = time.process_time() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, best, os.path.getsize(file_name)))
+        os.remove(file_name)
+    return results
+
+
+def etree_opf(title, items, itemrefs, genres=[], author=False, language=False, publisher=False, description=False, series=False, number=False, uuids=None):
+    # the ElementTree + indent serialisation Epub.package_opf used before the byte templates, kept as reference
+    root = XTree.Element("package", {"xmlns": "http://www.idpf.org/2007/opf", "version": "3.0", "unique-identifier": "uid", "prefix": "ibooks: http://vocabulary.itunes.apple.com/rdf/ibooks/vocabulary-extensions-1.0/"})
+    metadata = XTree.SubElement(root, "metadata", {"xmlns:dc": "http://purl.org/dc/elements/1.1/", "xmlns:opf": "http://www.idpf.org/2007/opf"})
+    XTree.SubElement(metadata, "dc:title", {"id": "id"}).text = title
+    if author:
+        XTree.SubElement(metadata, "dc:creator", {"id": "id-1"}).text = author
+    if language:
+        XTree.SubElement(metadata, "dc:language").text = language
+    if publisher:
+        XTree.SubElement(metadata, "dc:publisher").text = publisher
+    for genre in genres:
+        XTree.SubElement(metadata, "dc:subject").text = genre
+    if description:
+        XTree.SubElement(metadata, "dc:description").text = description
+    XTree.SubElement(metadata, "dc:identifier").text = "uuid:"+uuids[0]
+    XTree.SubElement(metadata, "dc:identifier", {"id": "uid"}).text = "urn:uuid:"+uuids[1]
+    XTree.SubElement(metadata, "opf:meta", {"refines": "#id", "property": "title-type"}).text = "main"
+    XTree.SubElement(metadata, "opf:meta", {"refines": "#id", "property": "file-as"}).text = title
+    if series:
+        XTree.SubElement(metadata, "meta",{"property": "schema:isPartOf"}).text = series
+        XTree.SubElement(metadata, "meta",{"name": "calibre:series", "content": series})
+    if number:
+        XTree.SubElement(metadata, "meta", {"property": "schema:position"}).text = number
+        XTree.SubElement(metadata, "meta",{"name": "calibre:series_index", "content": number})
+    XTree.SubElement(metadata, "meta", {"name": "book-type", "content": "comic"})
+    XTree.SubElement(metadata, "meta", {"name": "cover", "content": "cover"})
+    XTree.SubElement(metadata, "meta", {"property": "dcterms:modified"}).text = "2000-03-24T00:00:00Z"
+    XTree.SubElement(metadata, "meta", {"property": "rendition:layout"}).text = "pre-paginated"
+    XTree.SubElement(metadata, "meta", {"name": "fixed-layout", "content": "true"})
+    manifest = XTree.SubElement(root, "manifest")
+    for (identifier, href, media, properties) in items:
+        item = {"id": identifier, "href": href, "media-type": media}
+        if properties:
+            item["properties"] = properties
+        XTree.SubElement(manifest, "item", item)
+    spine = XTree.SubElement(root, "spine", {"page-progression-direction": "rtl"})
+    for (idref, properties) in itemrefs:
+        XTree.SubElement(spine, "itemref", {"idref": idref, "properties": properties} if properties else {"idref": idref})
+    tree = XTree.ElementTree(root)
+    XTree.indent(tree, space="\t", level=0)
+    return XTree.tostring(root, encoding="utf-8", xml_declaration=True)
+
+
+def best_of(repeat, function, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function(*args, **kwargs)
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_opf(folder, count, repeat=5):
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        open(os.path.join(folder, "%04d.png" % i), "wb").close()
+    items, itemrefs = Epub.PageIndex(folder).manifest()
+    metadata = ("Title & <Volume>", items, itemrefs, ["Action", "Comedy"], "Author", "en", "Publisher", "Description", "Series", "1")
+    uuids = ("0", "1")
+    if etree_opf(*metadata, uuids=uuids) != Epub.package_opf(*metadata, uuids=uuids):
+        raise AssertionError("template and ElementTree OPF differ")
+    return [("elementtree", best_of(repeat, etree_opf, *metadata, uuids=uuids)),
+            ("template", best_of(repeat, Epub.package_opf, *metadata, uuids=uuids)),
+            ("template compact", best_of(repeat, Epub.package_opf, *metadata, uuids=uuids, pretty=False))]
+
+
+def bench_stages(folder, format="png", jobs=1, profile=None):
+    results = []
+    for mode in ("directory", "stream"):
+        work = folder + "-" + mode
+        shutil.copytree(folder, work)
+        Epub.STATS = Epub.Stats()
+        with Epub.stage("index"):
+            index = Epub.PageIndex(work, format)
+        pages = Epub.toc_pages(index.start)
+        if mode == "directory":
+            Epub.directory_epub(work+".epub", "Bench", index.start, pages, format=format, jobs=jobs, folder=work, index=index)
+        else:
+            Epub.stream_epub(work+".epub", "Bench", index.start, pages, format=format, jobs=jobs, folder=work, index=index, profile=profile)
+        results.append((mode, Epub.STATS))
+    Epub.STATS = None
+    return results
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="Usage: %prog [options] [zip] [opf] [stages]")
+    parser.add_option("-n", "--pages", action="store", type="int", dest="pages", default=100,
+                      help="number of synthetic pages (Default 100)")
+    parser.add_option("--width", action="store", type="int", dest="width", default=1200,
+                      help="page width in pixel (Default 1200)")
+    parser.add_option("--height", action="store", type="int", dest="height", default=1800,
+                      help="page height in pixel (Default 1800)")
+    parser.add_option("--jpg", action="store_const", dest="format", default="png", const="jpg",
+                      help="Image format (Default PNG)")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", default=3,
+                      help="runs per measurement, the best one is reported (Default 3)")
+    parser.add_option("-z", "--compress-level", action="store", type="int", dest="compresslevel", default=6,
+                      help="deflate level 0-9 for text members (Default 6)")
+    parser.add_option("--opf-pages", action="store", type="int", dest="opf_pages", default=1000,
+                      help="number of pages of the OPF serialisation benchmark (Default 1000)")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1,
+                      help="worker processes of the stages benchmark (Default 1)")
+    parser.add_option("--profile", action="store", type="choice", choices=sorted(Epub.PROFILES), dest="profile", default=None,
+                      help="device profile of the stream build in the stages benchmark")
+    parser.add_option("--json", action="store_const", dest="stats", default="text", const="json",
+                      help="report the stages benchmark as json")
+    (options, args) = parser.parse_args()
+    sections = args or ["zip", "opf", "stages"]
+    with tempfile.TemporaryDirectory() as tmp:
+        if "zip" in sections:
+            folder = os.path.join(tmp, "bench")
+            generate_pages(folder, options.pages, options.width, options.height, options.format)
+            Epub.generate_structure(folder, "000", format=options.format)
+            print("%-10s %12s %14s" % ("policy", "cpu (s)", "size (bytes)"))
+            for (name, elapsed, size) in bench_zip(folder, options.repeat, options.compresslevel):
+                print("%-10s %12.3f %14d" % (name, elapsed, size))
+        if "opf" in sections:
+            print("%-18s %12s" % ("opf (%d pages)" % options.opf_pages, "time (ms)"))
+            for (name, elapsed) in bench_opf(os.path.join(tmp, "opf"), options.opf_pages, options.repeat):
+                print("%-18s %12.2f" % (name, elapsed * 1000))
+        if "stages" in sections:
+            folder = os.path.join(tmp, "stages")
+            generate_pages(folder, options.pages, options.width, options.height, options.format)
+            for (mode, stats) in bench_stages(folder, options.format, options.jobs, options.profile):
+                print("%s build, %d pages of %dx%d %s" % (mode, options.pages, options.width, options.height, options.format))
+                print(stats.report(options.stats))